@@ -505,7 +505,7 @@ def train_model(data,model,visualisation,hyperparam):
         df = df.append(new_scores,ignore_index=True)
         model_results = {}
         if visualisation == "pca":
-            x_grid,y_grid,_,z = eva.contour(np.array(data['x_train']))
+            x_grid,y_grid,_,z = eva.contour(np.array(data['x_train']), adaptive=True)
 
             model_results = {
                 'x_grid':x_grid.tolist(),
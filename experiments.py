@@ -1,4 +1,4 @@
-from modules.evaluation import EvaluationFramework
+from modules.evaluation import EvaluationFramework, plot_reduced
 from modules.metrics import metrics
 
 from pyod.models.iforest import IForest
@@ -10,8 +10,11 @@ from pyod.utils.utility import standardizer
 
 import pandas as pd
 import re
+import matplotlib
 import matplotlib.pyplot as plt
 
+from concurrent.futures import ProcessPoolExecutor
+
 from os import listdir
 from os.path import isfile, join
 from scipy.io import loadmat
@@ -26,7 +29,24 @@ methods = {
 }
 
 
-def run():
+def _use_agg():
+    # Renderers draw off-screen
+    matplotlib.use('Agg')
+
+
+def render(x_reduced, y_pred, method, title):
+    '''
+        Rendering stage, draws and saves the figure of an embedding
+        of a test set coloured by predicted labels
+    '''
+    fig = plt.figure()
+    plot_reduced(x_reduced, y_pred, method)
+    plt.title(title)
+    fig.savefig(f'results/figures/{title}.png',bbox_inches="tight")
+    plt.close(fig)
+
+
+def run(n_renderers=2):
     scoring = list(metrics.keys())
     columns = ["dataset", "method",] + scoring
     df = pd.DataFrame(
@@ -37,6 +57,10 @@ def run():
     onlyfiles = [join(dataset_folder, f) for f in listdir(dataset_folder) if isfile(join(dataset_folder, f))]
 
     index = 0
+    # Figures are rendered by a separate pool of processes, evaluation
+    # only queues the reduced coordinates and labels
+    renderer = ProcessPoolExecutor(max_workers=n_renderers, initializer=_use_agg)
+    figures = []
     for file in onlyfiles[:11]:
         mat = loadmat(file)
         X = mat['X']
@@ -64,13 +88,17 @@ def run():
             df.to_csv("results/results.csv",index=False)
 
             index += 1
-            for ele in ["pca","tsne"]:
-                plt.clf()
-                eva.visualise(X_test_norm,y=y_pred,method=ele)
+            for ele in ["pca","fast-tsne"]:
+                # Embeddings are cached, so each test set is reduced once per method
+                x_reduced = eva.dim_reduction(X_test_norm, method=ele)
                 title = f'{key}-{name}-{ele}'
-                plt.title(title)
-                plt.savefig(f'results/figures/{title}.png',bbox_inches="tight")
-                #plt.show()
+                figures.append(renderer.submit(render, x_reduced, y_pred, ele, title))
+
+    renderer.shutdown(wait=True)
+    # Surface any rendering errors
+    for figure in figures:
+        figure.result()
 
 
-run()
+if __name__ == '__main__':
+    run()
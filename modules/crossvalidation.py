@@ -1,38 +1,537 @@
 from .metrics import MetricCollection, metrics
+from .parallel import shared, shared_arrays, attach_shared
+from .ensemble import _fingerprint
+from pyod.models.iforest import IForest
+from pyod.models.pca import PCA
+from pyod.utils.utility import check_parameter, invert_order
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import StratifiedKFold
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from tqdm import tqdm
+import copy
+import hashlib
 import itertools
+import numbers
+import os
+import pickle
+import tempfile
+import time
 import numpy as np
 import pandas as pd
 
+# Row of TuningResults.folds, one per fold fit
+_FOLD_DTYPE = [('candidate', np.int64), ('rung', np.int64), ('fold', np.int64),
+               ('samples', np.int64), ('AUC', np.float64), ('time', np.float64), ('cached', bool)]
+
+def _refit_path(detector, params_list, X):
+    # Fit every parameter combination from scratch
+    for params in params_list:
+        yield detector(**params).fit(X)
+
+def _iforest_path(detector, params_list, X):
+    """
+        Grow a single forest with warm_start, each larger forest adds
+        trees to the previous one. With an integer random_state the
+        forests are identical to ones fitted from scratch.
+    """
+    model = None
+    for params in params_list:
+        if model is None:
+            model = detector(**params).fit(X)
+        elif params['n_estimators'] > model.n_estimators:
+            model.n_estimators = params['n_estimators']
+            model.detector_.set_params(n_estimators=model.n_estimators, warm_start=True)
+            model.detector_.fit(X)
+            model.decision_scores_ = invert_order(model.detector_.decision_function(X))
+            model._process_decision_scores()
+        yield model
+
+def _truncated_pca(pca, n_components):
+    # Copy of a fitted sklearn PCA keeping its leading n_components
+    small = copy.copy(pca)
+    small.n_components = small.n_components_ = n_components
+    for name in ('components_', 'explained_variance_', 'explained_variance_ratio_', 'singular_values_'):
+        setattr(small, name, getattr(pca, name)[:n_components])
+    # Noise variance is the mean of the discarded eigenvalues
+    rank = min(pca.n_samples_, pca.n_features_in_)
+    if n_components < rank:
+        discarded = pca.explained_variance_[n_components:].sum() + (rank - pca.n_components_) * pca.noise_variance_
+        small.noise_variance_ = discarded / (rank - n_components)
+    else:
+        small.noise_variance_ = 0.0
+    return small
+
+def _pca_path(detector, params_list, X):
+    """
+        Fit the largest PCA with the full SVD once, smaller models take
+        its leading components, as a full SVD fit of their own would.
+    """
+    full = detector(**{**params_list[-1], 'svd_solver': 'full'}).fit(X)
+    for params in params_list:
+        model = detector(**params)
+        model._set_n_classes(None)
+        if model.standardization:
+            model.scaler_ = full.scaler_
+        model.detector_ = _truncated_pca(full.detector_, params['n_components'])
+        model.n_components_ = model.detector_.n_components_
+        model.components_ = model.detector_.components_
+        model.w_components_ = np.ones([model.n_components_, ])
+        if model.weighted:
+            model.w_components_ = model.detector_.explained_variance_ratio_
+        model.n_selected_components_ = model.n_selected_components or model.n_components_
+        check_parameter(model.n_selected_components_, 1, model.n_components_,
+                        include_left=True, include_right=True, param_name='n_selected_components_')
+        model.selected_components_ = model.components_[-1 * model.n_selected_components_:, :]
+        model.selected_w_components_ = model.w_components_[-1 * model.n_selected_components_:]
+        model.decision_scores_ = model.decision_function(X)
+        model._process_decision_scores()
+        yield model
+
+# Detectors whose fits over a growing size parameter can reuse the
+# previous fit, as (size parameter, path, whether params are eligible)
+warm_starts = {
+    IForest: ('n_estimators', _iforest_path, lambda params: True),
+    PCA: ('n_components', _pca_path, lambda params: params.get('svd_solver', 'auto') in ('auto', 'full')),
+}
+
+def _fold_chain(X_train, X_test, y_test, detector, params_list, return_model=False):
+    """
+        Fit a chain of parameter combinations on one fold and return the
+        ROC-AUC on its held out part and the time taken of each. Chains
+        of more than one combination are fitted along the warm start path.
+    """
+    path = warm_starts[detector][1] if len(params_list) > 1 else _refit_path
+    results = []
+    start = time.perf_counter()
+    for model in path(detector, params_list, X_train):
+        auc = roc_auc_score(y_test, model.predict_proba(X_test)[:,1])
+        end = time.perf_counter()
+        results.append((auc, end - start) + ((copy.deepcopy(model),) if return_model else ()))
+        start = end
+    return results
+
+def _fold_predict(X_train, X_test, y_test, detector, params):
+    # Fit on one fold and return the anomaly probabilities of its held out part and the time taken
+    start = time.perf_counter()
+    model = detector(**params)
+    model.fit(X_train)
+    return model.predict_proba(X_test)[:,1], time.perf_counter() - start
+
+def _fold_arrays(X, y, train_idx, test_idx):
+    # Contiguous read-only (X_train, X_test, y_test) of a fold
+    arrays = X[train_idx], X[test_idx], y[test_idx]
+    for a in arrays:
+        a.flags.writeable = False
+    return arrays
+
+def _fold_key(train_idx, test_idx):
+    return (hashlib.blake2b(np.ascontiguousarray(train_idx)).digest(),
+            hashlib.blake2b(np.ascontiguousarray(test_idx)).digest())
+
+# Fold arrays built in this worker, by fold key, most recent last
+_worker_folds = OrderedDict()
+_WORKER_FOLDS = 2
+
+def _call_fold(func, key, train_idx, test_idx, *task):
+    # Workers build each fold from the shared X and y once and reuse it
+    # for the fold's following tasks, which are dispatched together
+    if key in _worker_folds:
+        _worker_folds.move_to_end(key)
+    else:
+        _worker_folds[key] = _fold_arrays(shared['X'], shared['y'], train_idx, test_idx)
+        while len(_worker_folds) > _WORKER_FOLDS:
+            _worker_folds.popitem(last=False)
+    return func(*_worker_folds[key], *task)
+
+@contextmanager
+def _task_runner(X, y, n_workers=1, progress=False):
+    """
+        Yields `run(func, folds, tasks, desc)` calling
+        `func(X_train, X_test, y_test, *task[1:])` for every task, with
+        the arrays of the fold `folds[task[0]]`, and returning results
+        in task order. Each fold's arrays are materialised once and
+        shared by all of its tasks. With n_workers != 1 tasks go to a
+        process pool, which is reused across calls in the block. X and y
+        are shared once through shared memory, tasks are dispatched fold
+        by fold and every worker builds a fold's arrays on its first task
+        of the fold, so only a couple of fold copies per worker exist.
+    """
+    if n_workers == 1:
+        def run(func, folds, tasks, desc=None):
+            by_fold = defaultdict(list)
+            for i, task in enumerate(tasks):
+                by_fold[task[0]].append(i)
+            # One fold is materialised at a time
+            results = [None] * len(tasks)
+            with tqdm(total=len(tasks), desc=desc, disable=not progress) as bar:
+                for k, idxs in by_fold.items():
+                    arrays = _fold_arrays(X, y, *folds[k])
+                    for i in idxs:
+                        results[i] = func(*arrays, *tasks[i][1:])
+                        bar.update()
+            return results
+        yield run
+        return
+
+    with shared_arrays(X=X, y=y) as spec:
+        with ProcessPoolExecutor(max_workers=None if n_workers == -1 else n_workers,
+                                 initializer=attach_shared, initargs=(spec,)) as pool:
+            def run(func, folds, tasks, desc=None):
+                keys = [_fold_key(*fold) for fold in folds]
+                futures = [None] * len(tasks)
+                for i in sorted(range(len(tasks)), key=lambda i: tasks[i][0]):
+                    k = tasks[i][0]
+                    futures[i] = pool.submit(_call_fold, func, keys[k], *folds[k], *tasks[i][1:])
+                for _ in tqdm(as_completed(futures), total=len(futures), desc=desc, disable=not progress):
+                    pass
+                return [f.result() for f in futures]
+            yield run
+
+class FoldCache:
+    """
+        On-disk cache of fold fit results, so re-running a search with
+        an extended grid only fits the new (params, fold) pairs.
+    ...
+
+        Entries are keyed by the detector class, its parameters, the
+        train and test indices of the fold and a fingerprint of the
+        data, each is a pickle of the fold's (AUC, fit time) and,
+        with `models`, the fitted model.
+
+    Attributes
+    ----------
+    directory : cache directory, created if missing and safe to share
+        between datasets, detectors and sessions
+    models : store the fitted fold models as well as their scores
+    """
+    def __init__(self, directory, models=False):
+        self.directory = directory
+        self.models = models
+        os.makedirs(directory, exist_ok=True)
+        self._data_key = None
+
+    def bind(self, X, y):
+        # Fingerprint the data once per evaluation rather than per fold
+        self._data_key = (_fingerprint(X), _fingerprint(y))
+        return self
+
+    def key(self, detector, params, train_idx, test_idx):
+        if self._data_key is None:
+            raise ValueError('FoldCache must be bound to the data with bind(X, y) first.')
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f'{detector.__module__}.{detector.__qualname__}'.encode())
+        h.update(repr(sorted(params.items())).encode())
+        h.update(repr(self._data_key).encode())
+        for idx in (train_idx, test_idx):
+            h.update(np.ascontiguousarray(idx, dtype=np.int64))
+            h.update(b'|')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, detector, params, train_idx, test_idx):
+        # (AUC, time) of a cached fold fit, None on a miss
+        try:
+            with open(self._path(self.key(detector, params, train_idx, test_idx)), 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if self.models and 'model' not in entry:
+            return None
+        return entry['AUC'], entry['time']
+
+    def put(self, detector, params, train_idx, test_idx, auc, fit_time, model=None):
+        entry = {'AUC': auc, 'time': fit_time}
+        if model is not None:
+            entry['model'] = model
+        # Written to a temporary file and renamed so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, self._path(self.key(detector, params, train_idx, test_idx)))
+
+    def load_model(self, detector, params, train_idx, test_idx):
+        """
+            Fitted model of a cached fold fit, None if it was not stored.
+        """
+        try:
+            with open(self._path(self.key(detector, params, train_idx, test_idx)), 'rb') as f:
+                return pickle.load(f).get('model')
+        except FileNotFoundError:
+            return None
+
+def _chains(tasks, fold_of, warm_start=False):
+    """
+        Group the fold fits of `tasks` in `fold_of` (task index to fold
+        number) into chains fitted together. With warm_start, fits of a detector in `warm_starts` on the same
+        fold that differ only in its size parameter form one chain in
+        increasing size, every other fit is a chain of its own.
+    """
+    chains, groups = [], {}
+    for i, fold in fold_of.items():
+        detector, params = tasks[i][:2]
+        size, _, eligible = warm_starts.get(detector, (None, None, None))
+        if not warm_start or size is None or not isinstance(params.get(size), numbers.Integral) \
+                or not eligible(params):
+            chains.append([i])
+            continue
+        key = (detector, repr(sorted((k, v) for k, v in params.items() if k != size)), fold)
+        if key not in groups:
+            groups[key] = []
+            chains.append(groups[key])
+        groups[key].append(i)
+    for chain in groups.values():
+        chain.sort(key=lambda i: tasks[i][1][warm_starts[tasks[i][0]][0]])
+    return chains
+
+def _run_fold_fits(run, tasks, cache=None, warm_start=False, desc=None):
+    """
+        (AUC, time, cached) of every (detector, params, train_idx,
+        test_idx) fold fit, only the fits missing from `cache` are run.
+    """
+    results = [cache.get(*task) for task in tasks] if cache is not None else [None] * len(tasks)
+    missing = [i for i, result in enumerate(results) if result is None]
+    # Fits on the same fold share its materialised arrays
+    folds, fold_numbers, fold_of = [], {}, {}
+    for i in missing:
+        key = _fold_key(*tasks[i][2:])
+        if key not in fold_numbers:
+            fold_numbers[key] = len(folds)
+            folds.append(tasks[i][2:])
+        fold_of[i] = fold_numbers[key]
+    chains = _chains(tasks, fold_of, warm_start)
+    return_model = cache is not None and cache.models
+    fits = run(_fold_chain, folds, [(fold_of[chain[0]], tasks[chain[0]][0], [tasks[i][1] for i in chain], return_model)
+                                    for chain in chains], desc=desc)
+    for chain, chain_fits in zip(chains, fits):
+        for i, fit in zip(chain, chain_fits):
+            if cache is not None:
+                cache.put(*tasks[i], *fit)
+            results[i] = fit[:2]
+    missing = set(missing)
+    return [tuple(result) + (i not in missing,) for i, result in enumerate(results)]
+
+class TuningResults:
+    """
+        Results of a `HyperparameterTune` run.
+    ...
+
+    Attributes
+    ----------
+    folds : record array with a row per fold fit (candidate, rung, fold,
+        samples, AUC, time, cached), filled in place as rounds complete.
+        time is that of the original fit for results read from a `FoldCache`
+    param_combs : parameter dicts, indexed by the candidate field
+    scores : DataFrame of the mean AUC of each candidate per rung
+    """
+    def __init__(self, folds, param_combs, scores):
+        self.folds = folds
+        self.param_combs = param_combs
+        self.scores = scores
+
+    def fold_frame(self):
+        """
+            DataFrame of every fold fit with its parameters.
+        """
+        params = pd.DataFrame([self.param_combs[i] for i in self.folds['candidate']])
+        return pd.concat([pd.DataFrame(self.folds), params], axis=1)
+
+class CrossvalidationResults:
+    """
+        Results of a `CrossvalidationFramework` run.
+    ...
+
+    Attributes
+    ----------
+    folds : record array with a row per outer fold holding each metric,
+        the total fold fit time of tuning and the time of the tuned fit
+    tuned_params : parameters dict selected in each outer fold
+    tuning : `TuningResults` of each outer fold
+    """
+    def __init__(self, folds, tuned_params, tuning):
+        self.folds = folds
+        self.tuned_params = tuned_params
+        self.tuning = tuning
+
+    def to_frame(self):
+        return pd.DataFrame(self.folds)
+
+def _tune(run, tuners, y, idxs, desc=None, cache=None, warm_start=False):
+    """
+        Run tuners on their rows `idxs` of the data in lockstep, every
+        round's fold fits of all tuners are dispatched together.
+        Returns the tuned parameters of each tuner.
+    """
+    for tuner, idx in zip(tuners, idxs):
+        tuner._start(y, idx)
+    pending = list(tuners)
+    while pending:
+        tasks = [tuner._tasks() for tuner in pending]
+        results = _run_fold_fits(run, [t for tuner_tasks in tasks for t in tuner_tasks], cache,
+                                 warm_start, desc)
+        still_pending, start = [], 0
+        for tuner, tuner_tasks in zip(pending, tasks):
+            if not tuner._update(results[start:start+len(tuner_tasks)]):
+                still_pending.append(tuner)
+            start += len(tuner_tasks)
+        pending = still_pending
+    return [tuner._best() for tuner in tuners]
+
+def _n_powers(n, start, factor):
+    # Largest k with start * factor**k <= n, counted exactly rather than with logs
+    k = 0
+    while start * factor ** (k + 1) <= n:
+        k += 1
+    return k
+
+def _check_search(search, factor, min_samples):
+    if search not in ('grid', 'halving'):
+        raise ValueError(f'Search {search} not recognised.')
+    if factor <= 1:
+        raise ValueError('factor must be greater than 1.')
+    if min_samples < 1:
+        raise ValueError('min_samples must be at least 1.')
+
 class HyperparameterTune:
-    def __init__(self, detector, n_splits=5, **parameters):
+    """
+        Hyperparameter search by stratified k-fold ROC-AUC.
+    ...
+
+    Attributes
+    ----------
+    detector : pointcloud model function
+    n_splits : number of folds
+    n_workers : number of worker processes for fold fits, -1 uses every core
+        (named apart from detector parameters such as n_jobs, which are tuned)
+    search (grid, halving): grid evaluates every parameter combination on
+        every fold. halving is successive halving, all candidates are
+        scored on small subsamples of each training fold and only the
+        best 1/factor move on to a `factor` times larger subsample,
+        until the survivors are scored on the full folds
+    factor : halving rate of candidates and growth rate of subsamples
+    min_samples : smallest training subsample size of the first rung
+    seed : seed of the training subsamples
+    cache : `FoldCache` or directory of one, fold fits already in the
+        cache are not refitted
+    warm_start : fit the combinations of a detector in `warm_starts`
+        that differ only in its size parameter (IForest n_estimators,
+        PCA n_components) together on each fold, growing one forest or
+        taking leading components of one full SVD rather than refitting
+    scores : DataFrame of the mean AUC of each evaluated combination, with
+        the rung and training subsample size when halving
+    results : `TuningResults` with every fold's AUC and fit time
+    """
+    def __init__(self, detector, n_splits=5, n_workers=1, search='grid', factor=3, min_samples=100,
+                 seed=None, cache=None, warm_start=False, **parameters):
+        _check_search(search, factor, min_samples)
         self.detector = detector
-        self.n_splits = n_splits 
+        self.n_splits = n_splits
+        self.n_workers = n_workers
+        self.search = search
+        self.factor = factor
+        self.min_samples = min_samples
+        self.seed = seed
+        self.cache = FoldCache(cache) if isinstance(cache, (str, os.PathLike)) else cache
+        self.warm_start = warm_start
         self.params = parameters
         self.param_keys = list(parameters.keys())
-    
+
     def evaluate(self, X, y):
-        self.scores = pd.DataFrame(columns=['AUC']+list(self.params.keys()))
-        tmp_n_splits = min(self.n_splits, int(sum(y)))
+        cache = self.cache.bind(X, y) if self.cache is not None else None
+        with _task_runner(X, y, self.n_workers) as run:
+            return _tune(run, [self], y, [np.arange(len(y))], cache=cache,
+                         warm_start=self.warm_start)[0]
+
+    def _start(self, y, idx):
+        """
+            Set up the folds of the rows `idx` of the data (fold
+            indices are into the full data) and the first rung.
+        """
+        tmp_n_splits = min(self.n_splits, int(sum(y[idx])))
         kf = StratifiedKFold(n_splits=tmp_n_splits)
-        fold_idxs = list(kf.split(X,y))
-        param_combs = itertools.product(*self.params.values())
-        
-        for param_comb in param_combs:
-            input_params = dict(zip(self.param_keys,param_comb))
-            score = []
-            for train_idx, test_idx in fold_idxs:
-                X_train = X[train_idx]
-                X_test, y_test = X[test_idx], y[test_idx]
-                model = self.detector(**input_params)
-                model.fit(X_train)
-                y_pred = model.predict_proba(X_test)
-                score.append(roc_auc_score(y_test, y_pred[:,1]))
-            self.scores = self.scores.append({'AUC':np.mean(score), **input_params}, ignore_index=True)
-        # Return parameters dict of first param combination with largest AUC
-        return self.scores.loc[self.scores['AUC']==self.scores['AUC'].max()].drop(['AUC'], axis=1).iloc[0].to_dict()
+        self._fold_idxs = [(idx[train_idx], idx[test_idx]) for train_idx, test_idx in kf.split(idx, y[idx])]
+        self._param_combs = [dict(zip(self.param_keys, comb)) for comb in itertools.product(*self.params.values())]
+        self._alive = np.arange(len(self._param_combs))
+        self._rounds = []
+
+        if self.search == 'grid':
+            self._n_rungs = 1
+        else:
+            # Rungs until one factor's worth of candidates is left, while
+            # the first rung's subsample stays above min_samples
+            n_train = min(len(train_idx) for train_idx, _ in self._fold_idxs)
+            n_rungs = 1 + _n_powers(len(self._candidates), 1, self.factor)
+            max_rungs = 1 + _n_powers(n_train, self.min_samples, self.factor)
+            self._n_rungs = max(1, min(n_rungs, max_rungs))
+            rng = np.random.default_rng(self.seed)
+            self._fold_idxs = [(rng.permutation(train_idx), test_idx) for train_idx, test_idx in self._fold_idxs]
+        self._rung = 0
+
+    @property
+    def _candidates(self):
+        return [self._param_combs[i] for i in self._alive]
+
+    def _tasks(self):
+        """
+            (detector, params, train_idx, test_idx) fold fits of the
+            current rung, ordered by candidate then fold.
+        """
+        self._n_samples = [self._rung_samples(len(train_idx)) for train_idx, _ in self._fold_idxs]
+        return [(self.detector, input_params, np.sort(train_idx[:n]), test_idx)
+                for input_params in self._candidates
+                for (train_idx, test_idx), n in zip(self._fold_idxs, self._n_samples)]
+
+    def _rung_samples(self, n_train):
+        return max(1, int(n_train * self.factor ** (self._rung - (self._n_rungs - 1))))
+
+    def _update(self, results):
+        """
+            Record the current rung's fold (AUC, time) results and
+            promote the best candidates. Returns True once the search
+            is finished.
+        """
+        n_alive, n_folds = len(self._alive), len(self._fold_idxs)
+        folds = np.zeros(n_alive * n_folds, dtype=_FOLD_DTYPE)
+        folds['candidate'] = np.repeat(self._alive, n_folds)
+        folds['rung'] = self._rung
+        folds['fold'] = np.tile(np.arange(n_folds), n_alive)
+        folds['samples'] = np.tile(self._n_samples, n_alive)
+        folds['AUC'], folds['time'], folds['cached'] = np.asarray(results, dtype=float).reshape(-1, 3).T
+        self._rounds.append(folds)
+
+        aucs = folds['AUC'].reshape(n_alive, n_folds).mean(axis=1)
+        self._rung += 1
+        if self._rung < self._n_rungs:
+            n_keep = max(1, int(np.ceil(n_alive / self.factor)))
+            # Stable order keeps the first of tied candidates, as the grid search does
+            best = np.argsort(-aucs, kind='stable')[:n_keep]
+            self._alive = self._alive[np.sort(best)]
+            return False
+
+        self._finish()
+        return True
+
+    def _finish(self):
+        # Fold results are materialised into DataFrames once, at the end of the search
+        folds = np.concatenate(self._rounds)
+        per_candidate = pd.DataFrame(folds).groupby(['rung', 'candidate'], sort=True)
+        means = per_candidate.agg(AUC=('AUC', 'mean'), Samples=('samples', 'mean')).reset_index()
+        scores = pd.concat([means[['AUC']],
+                            pd.DataFrame([self._param_combs[i] for i in means['candidate']],
+                                         columns=self.param_keys)], axis=1)
+        if self.search == 'halving':
+            scores['Rung'] = means['rung']
+            scores['Samples'] = means['Samples'].astype(int)
+        self.scores = scores
+        self.results = TuningResults(folds, self._param_combs, scores)
+
+    def _best(self):
+        # Return parameters dict of first param combination with largest AUC in the last rung
+        final_aucs = self.scores['AUC'].values[-len(self._alive):]
+        return dict(self._param_combs[self._alive[int(np.argmax(final_aucs))]])
 
     def fit(self, X,y, metrics=metrics, **parameters):
         # Fit model for particular parameter and retrieve score
@@ -43,29 +542,59 @@ class HyperparameterTune:
         return m.compute(y, y_pred)
 
 class CrossvalidationFramework:
-    def __init__(self, detector, n_splits=5, **parameters):
+    """
+        Nested cross-validation of a detector, parameters are tuned
+        with `HyperparameterTune` (see it for `search`, `factor`,
+        `min_samples`, `seed`, `cache` and `warm_start`) inside every
+        outer fold. `evaluate` returns the mean and std of each metric
+        over the outer folds and keeps the per-fold detail in `results`.
+    """
+    def __init__(self, detector, n_splits=5, n_workers=1, search='grid', factor=3, min_samples=100,
+                 seed=None, cache=None, warm_start=False, **parameters):
+        _check_search(search, factor, min_samples)
         self.detector = detector
-        self.n_splits = n_splits 
+        self.n_splits = n_splits
+        self.n_workers = n_workers
+        self.search = search
+        self.factor = factor
+        self.min_samples = min_samples
+        self.seed = seed
+        self.cache = FoldCache(cache) if isinstance(cache, (str, os.PathLike)) else cache
+        self.warm_start = warm_start
         self.params = parameters
         self.param_keys = list(parameters.keys())
-        
+
     def evaluate(self, X, y, metrics=metrics):
         # Determines scores based off metrics using cross-validation
         m = MetricCollection(metrics)
         metric_names = list(metrics.keys())
         kf = StratifiedKFold(n_splits=min(self.n_splits, int(sum(y))))
-        scores = pd.DataFrame(columns=metric_names)
-        
-        for train_idx, test_idx in tqdm(kf.split(X,y)):
-            X_train, y_train = X[train_idx], y[train_idx]
-            X_test, y_test = X[test_idx], y[test_idx]
-            # Nest Cross-Validation
-            h = HyperparameterTune(self.detector, self.n_splits, **self.params)
-            tuned_params = h.evaluate(X_train, y_train)
-            # Fit Tuned Model and Append Score
-            model = self.detector(**tuned_params)
-            model.fit(X_train)
-            
-            y_pred = model.predict_proba(X_test)[:,1]
-            scores = scores.append(m.compute(y_test, y_pred), ignore_index=True)
-        return scores.mean().to_dict(), scores.std().to_dict()
\ No newline at end of file
+        outer_idxs = list(kf.split(X,y))
+
+        cache = self.cache.bind(X, y) if self.cache is not None else None
+        with _task_runner(X, y, self.n_workers, progress=True) as run:
+            # Nest Cross-Validation, every round of fold fits of all
+            # outer folds is dispatched at once
+            tuners = [HyperparameterTune(self.detector, self.n_splits, search=self.search, factor=self.factor,
+                                         min_samples=self.min_samples, seed=self.seed,
+                                         **self.params) for _ in outer_idxs]
+            tuned_params = _tune(run, tuners, y, [train_idx for train_idx, _ in outer_idxs], desc='Tuning',
+                                 cache=cache, warm_start=self.warm_start)
+
+            # Fit Tuned Models and Score
+            fits = run(_fold_predict, outer_idxs, [(k, self.detector, params) for k, params in enumerate(tuned_params)],
+                       desc='Scoring')
+
+        folds = np.zeros(len(outer_idxs), dtype=[('fold', np.int64)] + [(name, np.float64) for name in metric_names]
+                                                 + [('tuning_time', np.float64), ('time', np.float64)])
+        folds['fold'] = np.arange(len(outer_idxs))
+        for i, ((_, test_idx), (y_pred, fit_time), tuner) in enumerate(zip(outer_idxs, fits, tuners)):
+            scores = m.compute(y[test_idx], y_pred)
+            for name in metric_names:
+                folds[name][i] = scores[name]
+            folds['tuning_time'][i] = tuner.results.folds['time'].sum()
+            folds['time'][i] = fit_time
+        self.results = CrossvalidationResults(folds, tuned_params, [tuner.results for tuner in tuners])
+
+        scores = pd.DataFrame(folds[metric_names])
+        return scores.mean().to_dict(), scores.std().to_dict()
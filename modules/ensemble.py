@@ -1,12 +1,523 @@
+import hashlib
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
+from scipy.special import erf, logsumexp
+from sklearn.metrics import roc_auc_score
+from sklearn.neighbors import NearestNeighbors
+from pyod.models.knn import KNN
+from pyod.models.lof import LOF
+from .parallel import shared, shared_arrays, attach_shared
 
 '''
     Module for ensembling methods
 '''
 
+
+def _fit_member(model, x):
+    """
+        Fit a single member and time it.
+    """
+    start = time.perf_counter()
+    model.fit(x)
+    return model, time.perf_counter() - start
+
+
+def _fit_member_shared(model):
+    """
+        Fit a single member on the worker's shared training data.
+    """
+    return _fit_member(model, shared['x'])
+
+
+def _member_outputs(model, x, normalisation='linear'):
+    """
+        Hard labels and anomaly probabilities of a fitted member
+        from a single scoring pass. pyod detectors are scored once
+        with decision_function and labelled/scaled the way their
+        predict and predict_proba (linear or unify) would.
+    """
+    if hasattr(model, 'decision_scores_') and hasattr(model, 'threshold_'):
+        scores = model.decision_function(x)
+        return (scores > model.threshold_).astype(int), _scale(scores, model.decision_scores_, normalisation)
+    return model.predict(x), model.predict_proba(x)[:, 1]
+
+
+def _scale(scores, train_scores, normalisation='linear'):
+    # Anomaly probabilities of raw scores relative to the training scores
+    if normalisation == 'unify':
+        z = (scores - train_scores.mean()) / (train_scores.std() or 1)
+        return np.clip(erf(z / np.sqrt(2)), 0, 1)
+    lo, hi = train_scores.min(), train_scores.max()
+    return np.clip((scores - lo) / ((hi - lo) or 1), 0, 1)
+
+
+def _training_proba(model, x, normalisation='linear'):
+    """
+        Anomaly probabilities of a fitted member on its training data
+        `x`, from the stored training scores of pyod detectors.
+    """
+    if hasattr(model, 'decision_scores_') and hasattr(model, 'threshold_'):
+        return _scale(model.decision_scores_, model.decision_scores_, normalisation)
+    return _member_outputs(model, x, normalisation)[1]
+
+
+def _fingerprint(x):
+    """
+        Cache key of an input batch from its shape, dtype and content.
+    """
+    x = np.ascontiguousarray(x)
+    return x.shape, x.dtype.str, hashlib.blake2b(x, digest_size=16).hexdigest()
+
+
+def iter_chunks(source, chunk_size):
+    """
+        Yield row blocks of at most `chunk_size` from an array
+        (including np.memmap, which is only read block by block)
+        or from an iterable of 2D batches.
+    """
+    if hasattr(source, 'shape'):
+        source = [source]
+    for batch in source:
+        for start in range(0, len(batch), chunk_size):
+            yield np.asarray(batch[start:start + chunk_size])
+
+
+def _weighted(scores, weights):
+    if weights is None:
+        raise ValueError('Weighted combination requires weights.')
+    return np.average(scores, axis=0, weights=weights)
+
+
+# Reductions over the member axis of a (num_models, n_samples) score matrix
+combination_methods = {
+    'avg': lambda scores, weights: scores.mean(axis=0),
+    'max': lambda scores, weights: scores.max(axis=0),
+    'median': lambda scores, weights: np.median(scores, axis=0),
+    'majority': lambda scores, weights: (scores > 0.5).mean(axis=0),
+    'weighted': _weighted
+}
+
+
+class CostCache:
+    """
+        Memory bounded LRU cache of ground cost and log-kernel
+        matrices for barycentre computations, keyed by support
+        grid, regularisation and dtype. Cached matrices are
+        read-only and shared between callers.
+    ...
+
+    Attributes
+    ----------
+    max_bytes : total size of cached matrices before the least
+        recently used are evicted
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._store = OrderedDict()
+
+    def cost(self, support, dtype=np.float64):
+        """
+            Squared euclidean cost between the points of `support`,
+            shape (n,) or (n, d), normalised to a maximum of 1.
+        """
+        support = np.asarray(support, dtype=float)
+        key = ('cost', _fingerprint(support), np.dtype(dtype).str)
+        if key not in self._store:
+            points = support.reshape(len(support), -1)
+            M = ((points[:, None, :] - points[None, :, :])**2).sum(-1)
+            M /= M.max() or 1
+            self._put(key, M.astype(dtype, copy=False))
+        return self._get(key)
+
+    def log_kernel(self, support, reg, dtype=np.float64):
+        """
+            Log Gibbs kernel -M/reg of the cost over `support`.
+        """
+        support = np.asarray(support, dtype=float)
+        key = ('log_kernel', _fingerprint(support), float(reg), np.dtype(dtype).str)
+        if key not in self._store:
+            self._put(key, (-self.cost(support, dtype) / reg).astype(dtype, copy=False))
+        return self._get(key)
+
+    def clear(self):
+        self._store.clear()
+        self.nbytes = 0
+
+    def _get(self, key):
+        self._store.move_to_end(key)
+        return self._store[key]
+
+    def _put(self, key, value):
+        value.setflags(write=False)
+        self._store[key] = value
+        self.nbytes += value.nbytes
+        # The newest entry is always kept even if it alone exceeds the bound
+        while self.nbytes > self.max_bytes and len(self._store) > 1:
+            _, evicted = self._store.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+
+cost_cache = CostCache()
+
+
+def bin_centres(n_bins):
+    """
+        Centres of `n_bins` equal-width bins on [0, 1].
+    """
+    return (np.arange(n_bins) + 0.5) / n_bins
+
+
+def cost_matrix(n_bins, dtype=np.float64):
+    """
+        Normalised squared euclidean ground cost between
+        histogram bins on [0, 1], served from `cost_cache`.
+    """
+    return cost_cache.cost(bin_centres(n_bins), dtype)
+
+
+def sinkhorn_barycentre(A, M, reg, weights, n_iter=1000, tol=1e-9, log_v=None, log_K=None):
+    """
+        Entropic Wasserstein barycentre by log-domain Sinkhorn
+        iterations (iterative Bregman projections), stable for
+        small `reg`.
+
+        A : histograms as columns, shape (n_bins, n_hists), or a batch
+            of such problems with shape (n_batches, n_bins, n_hists)
+        M : ground cost, shape (n_bins, n_bins)
+        weights : barycentric weights, shape (n_hists,)
+        log_v : dual potentials returned by a previous call, used to
+            warm-start iterations on similar histograms
+        log_K : precomputed log kernel -M/reg, e.g. from `cost_cache`
+
+        Returns the barycentre, shape (n_bins,) or (n_batches, n_bins),
+        and the final dual potentials.
+    """
+    A = np.asarray(A, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / weights.sum()
+    log_K = (-M / reg if log_K is None else log_K)[:, :, None]
+    with np.errstate(divide='ignore'):
+        log_A = np.log(A).astype(log_K.dtype, copy=False)
+    log_v = np.zeros_like(log_A) if log_v is None or log_v.shape != A.shape else log_v
+
+    log_bary = None
+    for i in range(n_iter):
+        log_u = log_A - logsumexp(log_K + log_v[..., None, :, :], axis=-2)
+        log_Ktu = logsumexp(log_K + log_u[..., :, None, :], axis=-3)
+        log_bary_new = log_Ktu @ weights.astype(log_K.dtype)
+        log_v = log_bary_new[..., None] - log_Ktu
+        # Convergence is checked every few iterations to save the exp
+        if log_bary is not None and i % 10 == 0:
+            if np.abs(np.exp(log_bary_new) - np.exp(log_bary)).sum(-1).max() < tol:
+                log_bary = log_bary_new
+                break
+        log_bary = log_bary_new
+
+    bary = np.exp(log_bary)
+    return bary / bary.sum(-1, keepdims=True), log_v
+
+
+def expand_parameters(parameter_list, expansion='zip', n_samples=None, random_state=None):
+    """
+        List the member parameter dicts of a parameter grid.
+
+        expansion (zip, product, sample): zip pairs the i-th value of
+            every parameter, product takes the full Cartesian grid and
+            sample draws `n_samples` distinct grid points without
+            materialising the grid
+    """
+    keys = list(parameter_list.keys())
+    values = [list(v) for v in parameter_list.values()]
+    if expansion == 'zip':
+        return [dict(zip(keys, comb)) for comb in zip(*values)]
+    elif expansion == 'product':
+        return [dict(zip(keys, comb)) for comb in itertools.product(*values)]
+    elif expansion == 'sample':
+        if n_samples is None:
+            raise ValueError('Sample expansion requires n_samples.')
+        sizes = [len(v) for v in values]
+        total = int(np.prod(sizes, dtype=object))
+        rng = np.random.default_rng(random_state)
+        # Grid points are drawn as flat indices and decoded per parameter
+        flat = sorted(int(i) for i in rng.choice(total, size=min(n_samples, total), replace=False))
+        param_dicts = []
+        for index in flat:
+            comb = []
+            for v, size in zip(reversed(values), reversed(sizes)):
+                index, j = divmod(index, size)
+                comb.append(v[j])
+            param_dicts.append(dict(zip(keys, reversed(comb))))
+        return param_dicts
+    raise ValueError(f'Expansion {expansion} not recognised.')
+
+
+class _Member:
+    def __init__(self, params):
+        self.params = params
+        self.model = None
+        self.path = None
+        self.fitted = False
+        self.fit_time = None
+
+
+class MemberStore:
+    """
+        List-like container of ensemble members that constructs each
+        member from its parameters on first access and fits it on
+        demand. At most `max_resident` members are kept in memory,
+        the least recently used fitted members are spilled to disk
+        with pickle and reloaded when accessed again.
+    ...
+
+    Attributes
+    ----------
+    model_func : pointcloud model function
+    max_resident : maximum number of members held in memory, None for no cap
+    spill_dir : directory for spilled members, a temporary directory by
+        default, which is removed by `close` or when the store is collected
+    """
+    def __init__(self, model_func, member_params, max_resident=None, spill_dir=None):
+        self.model_func = model_func
+        self.max_resident = max_resident
+        self.spill_dir = spill_dir
+        self._members = []
+        self._resident = OrderedDict()
+        self._x = None
+        self._cleanup = None
+        self.extend(member_params)
+
+    @property
+    def fit_times(self):
+        return [m.fit_time for m in self._members]
+
+    def fit(self, x):
+        """
+            Set the training data, members are refitted on next access.
+        """
+        self._x = x
+        for member in self._members:
+            self._drop_spill(member)
+            member.model, member.fitted, member.fit_time = None, False, None
+        self._resident.clear()
+
+    def extend(self, param_dicts):
+        self._members += [_Member(params) for params in param_dicts]
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        member = self._members[i]
+        if member.model is None:
+            if member.path is not None:
+                with open(member.path, 'rb') as f:
+                    member.model = pickle.load(f)
+            else:
+                member.model = self.model_func(**member.params)
+        if self._x is not None and not member.fitted:
+            member.model, member.fit_time = _fit_member(member.model, self._x)
+            member.fitted = True
+
+        self._resident[id(member)] = member
+        self._resident.move_to_end(id(member))
+        while self.max_resident is not None and len(self._resident) > self.max_resident:
+            _, evicted = self._resident.popitem(last=False)
+            self._spill(evicted)
+        return member.model
+
+    def __delitem__(self, i):
+        member = self._members.pop(i)
+        self._resident.pop(id(member), None)
+        self._drop_spill(member)
+
+    def _spill(self, member):
+        # Unfitted members are cheaper to rebuild than to store
+        if member.fitted and member.path is None:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='ensemble_members_')
+                self._cleanup = weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+            fd, member.path = tempfile.mkstemp(suffix='.pkl', dir=self.spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(member.model, f)
+        member.model = None
+
+    def close(self):
+        """
+            Remove spilled members from disk, and the spill directory
+            if the store created it. Spilled members are rebuilt and
+            refitted on next access.
+        """
+        for member in self._members:
+            if member.path is not None:
+                self._drop_spill(member)
+                member.fitted, member.fit_time = False, None
+        if self._cleanup is not None:
+            self._cleanup()
+            self._cleanup = None
+            self.spill_dir = None
+
+    def _drop_spill(self, member):
+        if member.path is not None:
+            os.remove(member.path)
+            member.path = None
+
+
+# Parameters of the neighbour search shared by every member
+_INDEX_PARAMS = ('algorithm', 'leaf_size', 'metric', 'p', 'metric_params', 'n_jobs')
+
+
+class SharedNeighbours:
+    """
+        k-nearest-neighbour graph of the training data built once at
+        the largest k of an ensemble. Members slice the first k
+        columns of the graph, and each scoring batch is queried once
+        at the largest k for all members.
+    ...
+
+    Attributes
+    ----------
+    n_neighbors : largest number of neighbours of any member
+    index_params : NearestNeighbors parameters (algorithm, metric, ...)
+    dist_, ind_ : distances and indices of the training points' neighbours,
+        excluding the point itself, shape (n_samples, n_neighbors)
+    """
+    def __init__(self, n_neighbors, **index_params):
+        self.n_neighbors = n_neighbors
+        self.index_params = index_params
+        self._query = (None, None)
+
+    def fit(self, x):
+        self.nn_ = NearestNeighbors(n_neighbors=self.n_neighbors, **self.index_params).fit(x)
+        self.dist_, self.ind_ = self.nn_.kneighbors()
+        self._query = (None, None)
+        return self
+
+    def query(self, x):
+        """
+            Neighbours of a batch among the training points, the last
+            batch's result is reused by the next member.
+        """
+        key = _fingerprint(x)
+        if self._query[0] != key:
+            self._query = (key, self.nn_.kneighbors(x, n_neighbors=self.n_neighbors))
+        return self._query[1]
+
+
+class _NeighbourMember:
+    """
+        Ensemble member scored from a slice of a `SharedNeighbours`
+        graph, exposing the pyod detector attributes and methods
+        used by the ensembles. `fit` assumes the shared graph has
+        been fitted on the same data.
+    """
+    def __init__(self, shared, n_neighbors, contamination=0.1):
+        self.shared = shared
+        self.n_neighbors = n_neighbors
+        self.contamination = contamination
+
+    def fit(self, x):
+        k = self.n_neighbors
+        self._fit_graph(self.shared.dist_[:, :k], self.shared.ind_[:, :k])
+        self.threshold_ = np.percentile(self.decision_scores_, 100 * (1 - self.contamination))
+        self.labels_ = (self.decision_scores_ > self.threshold_).astype(int)
+        return self
+
+    def decision_function(self, x):
+        dist, ind = self.shared.query(x)
+        return self._scores(dist[:, :self.n_neighbors], ind[:, :self.n_neighbors])
+
+    def predict(self, x):
+        return (self.decision_function(x) > self.threshold_).astype(int)
+
+    def predict_proba(self, x):
+        _, proba = _member_outputs(self, x)
+        return np.column_stack([1 - proba, proba])
+
+
+class SharedKNN(_NeighbourMember):
+    """
+        pyod KNN (largest, mean or median distance) on a shared graph.
+    """
+    def __init__(self, shared, n_neighbors=5, method='largest', contamination=0.1):
+        super().__init__(shared, n_neighbors, contamination)
+        self.method = method
+
+    def _fit_graph(self, dist, ind):
+        self.decision_scores_ = self._scores(dist, ind)
+
+    def _scores(self, dist, ind):
+        if self.method == 'mean':
+            return dist.mean(axis=1)
+        elif self.method == 'median':
+            return np.median(dist, axis=1)
+        return dist[:, -1]
+
+
+class SharedLOF(_NeighbourMember):
+    """
+        pyod LOF (novelty mode) on a shared graph.
+    """
+    def __init__(self, shared, n_neighbors=20, contamination=0.1):
+        super().__init__(shared, n_neighbors, contamination)
+
+    def _fit_graph(self, dist, ind):
+        self._k_dist = dist[:, -1]
+        self._lrd_train = self._lrd(dist, ind)
+        self.decision_scores_ = self._scores(dist, ind)
+
+    def _lrd(self, dist, ind):
+        reach_dist = np.maximum(dist, self._k_dist[ind])
+        return 1 / (reach_dist.mean(axis=1) + 1e-10)
+
+    def _scores(self, dist, ind):
+        return (self._lrd_train[ind] / self._lrd(dist, ind)[:, None]).mean(axis=1)
+
+
+def shared_neighbour_members(model, member_params, shared=None):
+    """
+        Build `SharedKNN`/`SharedLOF` members for pyod KNN or LOF
+        parameter dicts on one `SharedNeighbours` graph, grown to the
+        largest n_neighbors. Returns the members and the graph.
+    """
+    if not issubclass(model, (KNN, LOF)):
+        raise ValueError('Shared neighbours require pyod KNN or LOF members.')
+    defaults = model().get_params()
+    params = [{**defaults, **p} for p in member_params]
+    index_params = {k: params[0][k] for k in _INDEX_PARAMS if k in params[0]}
+    if shared is not None and shared.index_params != index_params:
+        raise ValueError('Members must share their neighbour search parameters.')
+    if any({k: p[k] for k in index_params} != index_params for p in params):
+        raise ValueError('Members must share their neighbour search parameters.')
+
+    max_k = max(p['n_neighbors'] for p in params)
+    if shared is None:
+        shared = SharedNeighbours(max_k, **index_params)
+    shared.n_neighbors = max(shared.n_neighbors, max_k)
+
+    if issubclass(model, KNN):
+        members = [SharedKNN(shared, p['n_neighbors'], p['method'], p['contamination']) for p in params]
+    else:
+        members = [SharedLOF(shared, p['n_neighbors'], p['contamination']) for p in params]
+    return members, shared
+
+
 class EnsembleModelParameters:
     """
-        Ensembling by averaging the predictions of a model 
+        Ensembling by averaging the predictions of a model
         fitted with different parameters.
     ...
 
@@ -14,38 +525,500 @@ class EnsembleModelParameters:
     ----------
     model_func : pointcloud model function
     model: list of models
+    member_params : parameter dict of each member, in member order
     parameter_list : dictionary of the form (parameter_name, list of parameters)
-    method (max, avg): max/avg takes the maximum/average anomaly score as the prediction
+    expansion (zip, product, sample): how parameter_list is expanded into
+        members, see `expand_parameters`
+    n_samples, random_state : number of grid points and seed for sample expansion
+    lazy : hold members in a `MemberStore`, constructing and fitting each
+        one serially on first use instead of up front
+    max_resident : with lazy, maximum fitted members kept in memory,
+        the rest are spilled to `spill_dir`
+    shared_neighbours : for pyod KNN/LOF sweeps, build one neighbour graph
+        at the largest n_neighbors and slice it per member, see `SharedNeighbours`.
+        These members are fitted in-process whatever the executor
+    method (avg, max, median, majority, weighted): how member anomaly scores are
+        combined, majority takes the fraction of members flagging a sample
+        and weighted averages with `weights`
+    weights : per-member weights for the weighted method
+    n_jobs : number of workers used to fit members, -1 uses every core
+    executor (thread, process or Executor): thread pool for estimators that
+        release the GIL, process pool (training data in shared memory) for the rest
+    cache_size : number of input batches whose member scores are kept (LRU),
+        each holding an int8 label and a float64 probability matrix of
+        shape (num_models, n_samples). One serves predict followed by
+        predict_proba or scoring on the same batch
+    keep_batches : keep a read-only copy of each cached batch so members
+        added later extend its cached scores, otherwise `add_members`
+        drops the cached scores
+    fit_times_ : fit time in seconds of each member, in member order
     """
-    def __init__(self, model, parameter_list, method='avg'):
+    # Scaling of member scores to probabilities, see `_member_outputs`
+    normalisation = 'linear'
+
+    def __init__(self, model, parameter_list, method='avg', weights=None, n_jobs=1, executor='thread',
+                 cache_size=1, expansion='zip', n_samples=None, random_state=None, lazy=False,
+                 max_resident=None, spill_dir=None, shared_neighbours=False, keep_batches=False):
         self.model_func = model
         self.parameter_list = parameter_list
-        
-        param_dictlist = map(dict, zip(*[[(k, v) for v in value] for k, value in parameter_list.items()]))
-        self.models = [model(**params_dict) for params_dict in param_dictlist]
+
+        self.member_params = expand_parameters(parameter_list, expansion, n_samples, random_state)
+        self._shared = None
+        if shared_neighbours:
+            if lazy:
+                raise ValueError('Shared neighbours members are not built lazily.')
+            self.models, self._shared = shared_neighbour_members(model, self.member_params)
+        elif lazy:
+            self.models = MemberStore(model, self.member_params, max_resident, spill_dir)
+        else:
+            self.models = [model(**params_dict) for params_dict in self.member_params]
+        self.lazy = lazy
         self.num_models = len(self.models)
+        if method not in combination_methods:
+            raise ValueError(f'Method {method} not recognised.')
         self.method = method
-        
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self._fit_times = []
+        self.cache_size = cache_size
+        self._score_cache = OrderedDict()
+        self.keep_batches = keep_batches
+        self._x_train = None
+
+    @property
+    def fit_times_(self):
+        return self.models.fit_times if self.lazy else self._fit_times
+
     def fit(self, x):
-        for i in range(len(self.models)):
-            self.models[i].fit(x)
-    
+        self._x_train = x
+        self._score_cache.clear()
+        if self.lazy:
+            self.models.fit(x)
+            return
+        if self._shared is not None:
+            self._shared.fit(x)
+            results = self._fit_shared(self.models, x)
+        else:
+            results = self._fit_members(self.models, x)
+
+        self.models = [m for m, _ in results]
+        self._fit_times = [t for _, t in results]
+
+    def add_members(self, param_dicts, weights=None):
+        """
+            Add members built from a list of parameter dicts. If the
+            ensemble is fitted, only the new members are fitted on the
+            cached training data and cached batch scores are extended
+            with their rows instead of being rescored.
+        """
+        if (self.weights is None) != (weights is None):
+            raise ValueError('Weights must be given for new members exactly when the ensemble is weighted.')
+        param_dicts = list(param_dicts)
+        if self.lazy:
+            self.models.extend(param_dicts)
+        elif self._shared is not None:
+            k = self._shared.n_neighbors
+            new_models, _ = shared_neighbour_members(self.model_func, param_dicts, self._shared)
+            if self._x_train is not None:
+                # A deeper graph keeps the first k columns, so existing
+                # members and their cached scores are unchanged
+                if self._shared.n_neighbors > k:
+                    self._shared.fit(self._x_train)
+                    self.models = [m for m, _ in self._fit_shared(self.models, self._x_train)]
+                results = self._fit_shared(new_models, self._x_train)
+                new_models = [m for m, _ in results]
+                self._fit_times += [t for _, t in results]
+            self.models += new_models
+        else:
+            new_models = [self.model_func(**params_dict) for params_dict in param_dicts]
+            if self._x_train is not None:
+                results = self._fit_members(new_models, self._x_train)
+                new_models = [m for m, _ in results]
+                self._fit_times += [t for _, t in results]
+            self.models += new_models
+
+        new_idxs = range(self.num_models, len(self.models))
+        self.member_params += param_dicts
+        self.num_models = len(self.models)
+        if weights is not None:
+            self.weights = np.concatenate([self.weights, np.asarray(weights, dtype=float)])
+
+        if self._x_train is not None:
+            self._extend_cache(new_idxs)
+
+    def remove_member(self, i):
+        """
+            Remove the i-th member and its rows from cached batch scores.
+        """
+        del self.models[i]
+        del self.member_params[i]
+        if not self.lazy and self._fit_times:
+            del self._fit_times[i]
+        self.num_models = len(self.models)
+        if self.weights is not None:
+            self.weights = np.delete(self.weights, i)
+        for key, (x, labels, probas) in self._score_cache.items():
+            self._score_cache[key] = (x, np.delete(labels, i, axis=0), np.delete(probas, i, axis=0))
+
+    def _extend_cache(self, new_idxs):
+        """
+            Append the rows of new members to cached batch scores,
+            scoring them on the kept batches, or drop the cached
+            scores when batches are not kept.
+        """
+        if not self.keep_batches:
+            self._score_cache.clear()
+            return
+        for key, (x, labels, probas) in self._score_cache.items():
+            new_labels, new_probas = self._score_models(x, new_idxs)
+            self._score_cache[key] = (x, np.vstack([labels, new_labels]), np.vstack([probas, new_probas]))
+
+    def _fit_members(self, models, x):
+        """
+            Fit `models` with the configured executor, returning
+            (model, fit time) pairs in member order.
+        """
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        n_jobs = max(1, min(n_jobs, len(models)))
+
+        if isinstance(self.executor, Executor):
+            return self._fit_executor(self.executor, models, x)
+        elif n_jobs == 1:
+            return [_fit_member(m, x) for m in models]
+        elif self.executor == 'thread':
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                return self._fit_executor(pool, models, x)
+        elif self.executor == 'process':
+            return self._fit_processes(models, x, n_jobs)
+        raise ValueError(f'Executor {self.executor} not recognised.')
+
+    def _fit_shared(self, models, x):
+        """
+            Fit shared neighbour members in-process, whatever the
+            executor. Fitting only slices the shared graph, and members
+            sent to worker processes would come back with their own copy.
+        """
+        results = [_fit_member(m, x) for m in models]
+        for m, _ in results:
+            m.shared = self._shared
+        return results
+
+    def _fit_executor(self, pool, models, x):
+        # Results are gathered in submission order so members keep their index
+        futures = [pool.submit(_fit_member, m, x) for m in models]
+        return [f.result() for f in futures]
+
+    def _fit_processes(self, models, x, n_jobs):
+        with shared_arrays(x=x) as spec:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=attach_shared,
+                                     initargs=(spec,)) as pool:
+                futures = [pool.submit(_fit_member_shared, m) for m in models]
+                return [f.result() for f in futures]
+
     def predict(self, x):
-        y_preds = np.zeros(x.shape[0])
-        for i in range(self.num_models):
-            if self.method == 'max':
-                y_preds = np.maximum(y_preds, self.models[i].predict(x))
-            else:
-                y_preds += self.models[i].predict(x)
-            
-        y_preds = np.array([1 if i >= self.num_models/2 else 0 for i in y_preds])
-        return y_preds
-    
+        labels, _ = self._member_scores(x)
+        return (self._combine(labels, self.weights) >= 0.5).astype(int)
+
     def predict_proba(self, x):
-        y_preds = np.zeros(x.shape[0])
-        for i in range(self.num_models):
-            if self.method == 'max':
-                y_preds = np.maximum(y_preds, self.models[i].predict_proba(x))
+        _, probas = self._member_scores(x)
+        y_preds = self._combine(probas, self.weights)
+        return np.column_stack([1 - y_preds, y_preds])
+
+    def predict_proba_iter(self, source, chunk_size=10000):
+        """
+            Score an array, memory-mapped array or iterable of batches
+            in chunks of `chunk_size` rows across all members, yielding
+            the (chunk, 2) probabilities of each chunk. Chunks bypass
+            the score cache so memory stays bounded by the chunk size.
+        """
+        for chunk in iter_chunks(source, chunk_size):
+            _, probas = self._member_scores(chunk, cache=False)
+            y_preds = self._combine(probas, self.weights)
+            yield np.column_stack([1 - y_preds, y_preds])
+
+    def _member_scores(self, x, cache=True):
+        """
+            Labels and anomaly probabilities of every member, each
+            written into a row of a (num_models, n_samples) matrix.
+            Both come from one scoring pass and are cached per input
+            so predict followed by predict_proba scores only once.
+        """
+        cache = cache and self.cache_size > 0
+        key = _fingerprint(x) if cache else None
+        if key in self._score_cache:
+            self._score_cache.move_to_end(key)
+            return self._score_cache[key][1:]
+
+        labels, probas = self._score_models(x)
+        if cache:
+            # A private copy of the batch is kept so members added later
+            # are scored on the rows the cache key was computed from
+            if self.keep_batches:
+                x = np.array(x)
+                x.flags.writeable = False
+            self._score_cache[key] = (x if self.keep_batches else None, labels, probas)
+            if len(self._score_cache) > self.cache_size:
+                self._score_cache.popitem(last=False)
+        return labels, probas
+
+    def _prepare(self, x):
+        """
+            Preprocessing applied to a batch before members score it.
+        """
+        return x
+
+    def _score_models(self, x, idxs=None):
+        # Cache keys use the raw batch, preprocessing only runs on a miss
+        x = self._prepare(x)
+        # Members are accessed one at a time so a lazy store can spill between them
+        idxs = range(self.num_models) if idxs is None else idxs
+        # Labels are 0/1, int8 keeps the cached label matrix an eighth of the size
+        labels = np.empty((len(idxs), x.shape[0]), dtype=np.int8)
+        probas = np.empty((len(idxs), x.shape[0]))
+        for row, i in enumerate(idxs):
+            labels[row], probas[row] = _member_outputs(self.models[i], x, self.normalisation)
+        return labels, probas
+
+    def prune(self, x, y=None, threshold=0.95, max_loss=0.01):
+        """
+            Drop members whose anomaly probabilities on the validation
+            sample `x` correlate above `threshold` with a kept member,
+            as long as the combined prediction stays within `max_loss`
+            of the full ensemble. The loss is the ROC-AUC drop when
+            labels `y` are given, otherwise one minus the correlation
+            between pruned and full combined scores. Most redundant
+            members are tried first.
+
+            Returns a report of the removed members (original indices)
+            and the inference time saved on `x`, also kept as
+            `pruning_report_`.
+        """
+        n = self.num_models
+        x = self._prepare(x)
+        probas = np.empty((n, x.shape[0]))
+        times = np.empty(n)
+        for i in range(n):
+            start = time.perf_counter()
+            _, probas[i] = _member_outputs(self.models[i], x, self.normalisation)
+            times[i] = time.perf_counter() - start
+
+        weights = np.ones(n) if self.weights is None else self.weights
+        full = self._combine(probas, self.weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = np.nan_to_num(np.corrcoef(probas))
+
+        keep = list(range(n))
+        loss = 0.0
+        for i in np.argsort(-corr.sum(axis=1), kind='stable'):
+            others = [j for j in keep if j != i]
+            if not others or corr[i, others].max() < threshold:
+                continue
+            pruned = self._combine(probas[others], None if self.weights is None else weights[others], others)
+            if y is not None:
+                candidate_loss = roc_auc_score(y, full) - roc_auc_score(y, pruned)
             else:
-                y_preds += self.models[i].predict_proba(x)/self.num_models
-        return y_preds
\ No newline at end of file
+                candidate_loss = 1 - np.corrcoef(full, pruned)[0, 1]
+            if candidate_loss <= max_loss:
+                keep, loss = others, candidate_loss
+
+        removed = sorted(set(range(n)) - set(keep))
+        for i in reversed(removed):
+            self.remove_member(i)
+
+        self.pruning_report_ = {
+            'removed': removed,
+            'num_models': self.num_models,
+            'loss': float(loss),
+            'time_saved': float(times[removed].sum()),
+            'time_saved_fraction': float(times[removed].sum() / times.sum())
+        }
+        return self.pruning_report_
+
+    def _combine(self, scores, weights, idxs=None):
+        # idxs are the members of the rows of `scores` when not all of them
+        return combination_methods[self.method](scores, weights)
+
+
+class BarycentreEnsemble(EnsembleModelParameters):
+    """
+        Ensembling via the Wasserstein barycentre of the members'
+        anomaly score distributions. At fit time each member's training
+        scores are binned into histograms and their Sinkhorn barycentre
+        is computed, then every member's scores are quantile-mapped
+        from its training distribution onto the barycentre before
+        averaging, so members with different score scales contribute
+        on a common, geometrically meaningful distribution. A sample's
+        probability does not depend on the rest of its batch.
+    ...
+
+    Attributes
+    ----------
+    bins : number of histogram bins over the [0, 1] probability range
+    reg : entropic regularisation of the barycentre
+    n_iter : maximum number of Sinkhorn iterations
+    tol : L1 change of the barycentre at which iterations stop
+    dtype : float dtype of the cached kernel and iterations, float32
+        halves kernel memory
+    barycentre_ : barycentre histogram of the members' training scores
+    histograms_ : member histograms of the training scores, shape (bins, num_models)
+    """
+    def __init__(self, model, parameter_list, weights=None, bins=20, reg=1e-2,
+                 n_iter=1000, tol=1e-9, dtype=np.float64, **kwargs):
+        # Members are always combined through the barycentre
+        if 'method' in kwargs:
+            raise ValueError('BarycentreEnsemble does not support method.')
+        super().__init__(model, parameter_list, method='avg', weights=weights, **kwargs)
+        self.bins = bins
+        self.reg = reg
+        self.n_iter = n_iter
+        self.tol = tol
+        self.dtype = dtype
+        self.barycentre_ = None
+        self.histograms_ = None
+        self._log_v = None
+
+    def fit(self, x):
+        super().fit(x)
+        self.histograms_ = self._histograms(range(self.num_models)).T
+        self.barycentre_ = self._barycentre(self.histograms_, self.weights)
+
+    def add_members(self, param_dicts, weights=None):
+        n = self.num_models
+        super().add_members(param_dicts, weights)
+        if self._x_train is not None:
+            self.histograms_ = np.hstack([self.histograms_, self._histograms(range(n, self.num_models)).T])
+            self.barycentre_ = self._barycentre(self.histograms_, self.weights)
+
+    def remove_member(self, i):
+        super().remove_member(i)
+        if self.histograms_ is not None:
+            self.histograms_ = np.delete(self.histograms_, i, axis=1)
+            self.barycentre_ = self._barycentre(self.histograms_, self.weights)
+
+    def predict(self, x):
+        return (self.predict_proba(x)[:, 1] >= 0.5).astype(int)
+
+    def _histograms(self, idxs):
+        # Histogram every member's training probabilities in one pass by offsetting bin indices per row
+        x = self._prepare(self._x_train)
+        scores = np.vstack([_training_proba(self.models[i], x, self.normalisation) for i in idxs])
+        num_models = scores.shape[0]
+        idx = np.clip((scores * self.bins).astype(int), 0, self.bins - 1)
+        idx += np.arange(num_models)[:, None] * self.bins
+        counts = np.bincount(idx.ravel(), minlength=num_models * self.bins)
+        return counts.reshape(num_models, self.bins) / scores.shape[1]
+
+    def _barycentre(self, hists, weights):
+        num_models = hists.shape[1]
+        weights = np.full(num_models, 1 / num_models) if weights is None else weights / weights.sum()
+        # Warm-started from the previous potentials, the kernel over the
+        # bins is shared by every ensemble through cost_cache
+        centres = bin_centres(self.bins)
+        barycentre, self._log_v = sinkhorn_barycentre(
+            hists, cost_cache.cost(centres, self.dtype), self.reg, weights,
+            n_iter=self.n_iter, tol=self.tol, log_v=self._log_v,
+            log_K=cost_cache.log_kernel(centres, self.reg, self.dtype))
+        return barycentre
+
+    def _combine(self, scores, weights, idxs=None):
+        num_models = scores.shape[0]
+        hists = self.histograms_
+        barycentre = self.barycentre_
+        if idxs is not None:
+            # Barycentre of a subset of members, e.g. while pruning
+            hists = hists[:, list(idxs)]
+            barycentre = self._barycentre(hists, weights)
+        weights = np.full(num_models, 1 / num_models) if weights is None else weights / weights.sum()
+        edges = np.linspace(0, 1, self.bins + 1)
+
+        # Quantile mapping of each member from its training distribution onto the barycentre
+        bary_cdf = np.concatenate([[0], np.cumsum(barycentre)])
+        y_preds = np.zeros(scores.shape[1])
+        for i in range(num_models):
+            member_cdf = np.concatenate([[0], np.cumsum(hists[:, i])])
+            quantiles = np.interp(scores[i], edges, member_cdf)
+            y_preds += weights[i] * np.interp(quantiles, bary_cdf, edges)
+        return y_preds
+
+
+class HeterogeneousEnsemble(EnsembleModelParameters):
+    """
+        Ensembling of detectors from different families (e.g. IForest,
+        KNN, LOF, PCA and OCSVM). The input is preprocessed once per
+        fit or scoring batch (standardisation with the training
+        statistics, cast to `dtype`, C-contiguous layout) and every
+        member reads the same buffer. Member scores are normalised
+        to anomaly probabilities before being combined.
+    ...
+
+    Attributes
+    ----------
+    detectors : dictionary of the form (name, detector instance)
+    names : member names, in member order
+    standardise : standardise features with the training mean and std
+    dtype : dtype of the shared preprocessed buffer
+    normalisation (linear, unify): min-max scaling of member scores over
+        their training scores, or a Gaussian (erf) scaling of their
+        standardised scores, as in pyod's predict_proba
+    """
+    def __init__(self, detectors, method='avg', weights=None, normalisation='unify',
+                 standardise=True, dtype=np.float32, **kwargs):
+        # Members are detector instances rather than built from parameters
+        for option in ('lazy', 'shared_neighbours'):
+            if kwargs.get(option):
+                raise ValueError(f'HeterogeneousEnsemble does not support {option}.')
+        super().__init__(None, {}, method=method, weights=weights, **kwargs)
+        self.names = list(detectors.keys())
+        self.models = list(detectors.values())
+        self.member_params = [self._params(m) for m in self.models]
+        self.num_models = len(self.models)
+        self.normalisation = normalisation
+        self.standardise = standardise
+        self.dtype = dtype
+        self.mean_ = None
+        self.scale_ = None
+
+    def fit(self, x):
+        x = np.asarray(x)
+        if self.standardise:
+            self.mean_ = x.mean(axis=0)
+            self.scale_ = x.std(axis=0)
+            self.scale_[self.scale_ == 0] = 1
+        super().fit(self._prepare(x))
+
+    def add_members(self, detectors, weights=None):
+        """
+            Add detectors from a dictionary of the form (name, detector
+            instance), fitting only them on the preprocessed training data.
+        """
+        if (self.weights is None) != (weights is None):
+            raise ValueError('Weights must be given for new members exactly when the ensemble is weighted.')
+        new_models = list(detectors.values())
+        if self._x_train is not None:
+            results = self._fit_members(new_models, self._x_train)
+            new_models = [m for m, _ in results]
+            self._fit_times += [t for _, t in results]
+
+        new_idxs = range(self.num_models, self.num_models + len(new_models))
+        self.models += new_models
+        self.names += list(detectors.keys())
+        self.member_params += [self._params(m) for m in new_models]
+        self.num_models = len(self.models)
+        if weights is not None:
+            self.weights = np.concatenate([self.weights, np.asarray(weights, dtype=float)])
+
+        self._extend_cache(new_idxs)
+
+    def remove_member(self, i):
+        del self.names[i]
+        super().remove_member(i)
+
+    def _prepare(self, x):
+        x = np.asarray(x)
+        if self.standardise and self.mean_ is not None:
+            x = (x - self.mean_) / self.scale_
+        return np.ascontiguousarray(x, dtype=self.dtype)
+
+    def _params(self, model):
+        return model.get_params() if hasattr(model, 'get_params') else {}
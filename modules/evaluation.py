@@ -2,10 +2,183 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from collections import OrderedDict
 from .metrics import metrics, MetricCollection
+from .ensemble import iter_chunks, _fingerprint, _member_outputs
+from scipy.interpolate import RegularGridInterpolator
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+from pynndescent import NNDescent
 from umap import UMAP
+import scipy.sparse as sp
+# Reducers with an inverse_transform, for decision surfaces
+contour_methods = ('pca', 'umap')
+
+# Fitted reducers, their embeddings and inverse-transformed grids, by
+# (method, dataset fingerprint), least recently used first
+_reducer_cache = OrderedDict()
+reducer_cache_size = 8
+
+def _reducer_entry(x, method):
+    key = (method, _fingerprint(x))
+    if key in _reducer_cache:
+        _reducer_cache.move_to_end(key)
+        return _reducer_cache[key]
+    reducer = reducers[method]()
+    entry = {'reducer': reducer, 'embedding': reducer.fit_transform(x), 'grids': {}}
+    _reducer_cache[key] = entry
+    while len(_reducer_cache) > reducer_cache_size:
+        _reducer_cache.popitem(last=False)
+    return entry
+
+def _perplexity_weights(sq_distances, perplexity, n_steps=64):
+    '''
+        Row-normalised Gaussian weights whose entropy matches `perplexity`,
+        the bandwidth of every row is found by bisection as in TSNE
+    '''
+    target = np.log(min(perplexity, sq_distances.shape[1] - 1 or 1))
+    d = sq_distances - sq_distances[:, :1]
+    lo, hi = np.zeros(len(d)), np.full(len(d), np.inf)
+    beta = np.ones(len(d))
+    for _ in range(n_steps):
+        w = np.exp(-d * beta[:, None])
+        p = w / w.sum(1, keepdims=True)
+        entropy = -(p * np.log(np.maximum(p, 1e-300))).sum(1)
+        # Entropy falls as beta grows
+        high = entropy > target
+        lo = np.where(high, beta, lo)
+        hi = np.where(high, hi, beta)
+        beta = np.where(np.isinf(hi), beta * 2, (lo + hi) / 2)
+    return p
+
+def _place(distances, indices, embedding, perplexity):
+    # Perplexity weighted mean of the embeddings of each point's neighbours
+    weights = _perplexity_weights(distances ** 2, perplexity)
+    return np.einsum('ij,ijk->ik', weights, embedding[indices])
+
+def _tsne_transform(entry, x, x_new):
+    '''
+        Out-of-sample TSNE, new points are placed at the perplexity
+        weighted mean of the embeddings of their nearest neighbours
+        in `x`, the initialisation openTSNE optimises from
+    '''
+    perplexity = entry['reducer'].perplexity
+    if 'neighbours' not in entry:
+        entry['neighbours'] = NearestNeighbors(n_neighbors=min(len(x), int(3 * perplexity) + 1)).fit(x)
+    distances, indices = entry['neighbours'].kneighbors(x_new)
+    return _place(distances, indices, entry['embedding'], perplexity)
+
+class FastTSNE:
+    '''
+        Barnes-Hut TSNE for large inputs. The Barnes-Hut angle is coarser
+        and the iterations fewer than TSNE's defaults. Inputs of more than
+        `max_samples` points are embedded on a random sample, the rest
+        are placed from their neighbours in the sample with `transform`.
+        The neighbour graph can come from pynndescent's approximate
+        nearest neighbours above `approximate_above` points, which only
+        builds faster than exact neighbours from around 50000 points,
+        so it is off by default.
+    ...
+
+    Attributes
+    ----------
+    perplexity, angle, max_iter : as in sklearn TSNE
+    max_samples : largest number of points embedded directly, None embeds all
+    approximate_above : number of points above which neighbours are approximate,
+        None always uses exact neighbours
+    random_state : seed of the sample, neighbour graph and embedding
+    sample_ : indices of the embedded points
+    embedding_ : embedding of the sample
+    '''
+    def __init__(self, perplexity=30.0, angle=0.8, max_iter=500, max_samples=5000,
+                 approximate_above=None, random_state=None):
+        self.perplexity = perplexity
+        self.angle = angle
+        self.max_iter = max_iter
+        self.max_samples = max_samples
+        self.approximate_above = approximate_above
+        self.random_state = random_state
+
+    def fit_transform(self, x):
+        x = np.asarray(x)
+        n = len(x)
+        if self.max_samples is not None and n > self.max_samples:
+            rng = np.random.default_rng(self.random_state)
+            self.sample_ = np.sort(rng.choice(n, self.max_samples, replace=False))
+        else:
+            self.sample_ = np.arange(n)
+        sample = x[self.sample_]
+        perplexity = min(self.perplexity, len(sample) - 1)
+        self._k = min(len(sample) - 1, int(3 * perplexity + 1))
+
+        # PCA initialisation scaled as TSNE's init='pca'
+        init = PCA(n_components=2, random_state=self.random_state).fit_transform(sample)
+        init = init / np.std(init[:, 0]) * 1e-4
+        tsne = TSNE(n_components=2, perplexity=perplexity, angle=self.angle, max_iter=self.max_iter,
+                    init=init, random_state=self.random_state)
+        if self.approximate_above is not None and len(sample) > self.approximate_above:
+            # Graph of each point's neighbours including itself, as TSNE expects
+            self._index = NNDescent(sample, n_neighbors=self._k + 1, random_state=self.random_state)
+            indices, distances = self._index.neighbor_graph
+            graph = sp.csr_matrix((distances.ravel(), indices.ravel(),
+                                   np.arange(0, indices.size + 1, self._k + 1)), shape=(len(sample),) * 2)
+            tsne.set_params(metric='precomputed')
+            self.embedding_ = tsne.fit_transform(graph)
+        else:
+            self._index = NearestNeighbors(n_neighbors=self._k).fit(sample)
+            self.embedding_ = tsne.fit_transform(sample)
+
+        embedding = np.empty((n, 2), dtype=self.embedding_.dtype)
+        embedding[self.sample_] = self.embedding_
+        rest = np.setdiff1d(np.arange(n), self.sample_)
+        if len(rest):
+            embedding[rest] = self.transform(x[rest])
+        return embedding
+
+    def transform(self, x_new):
+        '''
+            Place new points from their nearest neighbours in the sample
+        '''
+        if isinstance(self._index, NNDescent):
+            indices, distances = self._index.query(np.asarray(x_new), k=self._k)
+        else:
+            distances, indices = self._index.kneighbors(np.asarray(x_new))
+        return _place(distances, indices, self.embedding_, min(self.perplexity, len(self.sample_) - 1))
+
+reducers = {
+    'pca': lambda: PCA(n_components=2),
+    'tsne': lambda: TSNE(n_components=2),
+    'fast-tsne': FastTSNE,
+    'umap': UMAP,
+}
+
+def grid(x_reduced, resolution=50):
+    '''
+        Evenly spaced (resolution, resolution) grid over the bounding box
+        of `x_reduced`, returns its x and y coordinates and the
+        (resolution**2, 2) grid points ordered x-major
+    '''
+    x_min, y_min = x_reduced.min(0)
+    x_max, y_max = x_reduced.max(0)
+    xcoords = np.linspace(x_min, x_max, resolution)
+    ycoords = np.linspace(y_min, y_max, resolution)
+    xx, yy = np.meshgrid(xcoords, ycoords, indexing='ij')
+    return xcoords, ycoords, np.column_stack([xx.ravel(), yy.ravel()])
+
+def plot_reduced(x_reduced, y, method='pca'):
+    '''
+        Scatter of normal and anomalous points of a 2D embedding on the
+        current axes
+    '''
+    plt.plot(x_reduced[y==0,0], x_reduced[y==0,1], '.',label="Normal")
+    plt.plot(x_reduced[y==1,0], x_reduced[y==1,1], 'x',label="Anomaly")
+    plt.title(label=method.upper())
+    plt.legend()
+
+    if method == 'pca':
+        plt.ylabel('PCA2')
+        plt.xlabel('PCA1')
 
 class EvaluationFramework:
     def __init__(self, model, metrics=metrics):
@@ -23,26 +196,48 @@ class EvaluationFramework:
         y_pred = self.model.predict_proba(x)
         return y_pred
 
+    def predict_proba_iter(self, source, chunk_size=10000):
+        '''
+            Yields predict_proba of `source` (array, memory-mapped
+            array or iterable of batches) in chunks of `chunk_size` rows
+        '''
+        if hasattr(self.model, 'predict_proba_iter'):
+            yield from self.model.predict_proba_iter(source, chunk_size)
+            return
+        for chunk in iter_chunks(source, chunk_size):
+            yield self.model.predict_proba(chunk)
+
     def score(self,y,y_pred):
         scores = self.metrics.compute(y,y_pred)
         return scores
 
     def dim_reduction(self, x, method='pca'):
         '''
-            method :: pca, tsne, umap
+            method :: pca, tsne, fast-tsne, umap
             returns a (,2) numpy array
+            Embeddings are cached per dataset and method
         '''
-        if method == 'pca':
-            pca = PCA(n_components=2)
-            return pca.fit_transform(x)
-        elif method == 'tsne':
-            tsne = TSNE(n_components=2)
-            return tsne.fit_transform(x)
-        elif method == 'umap':
-            umap = UMAP()
-            return umap.fit_transform(x)
-        else:
+        if method not in reducers:
+            return None
+        return self._reducer(x, method)['embedding'].copy()
+
+    def project(self, x_new, x, method='pca'):
+        '''
+            Embed `x_new` into the (cached) embedding of `x` without
+            refitting, with the PCA projection, UMAP transform or an
+            out-of-sample TSNE placement
+            returns a (,2) numpy array
+        '''
+        if method not in reducers:
             return None
+        x = np.asarray(x)
+        entry = self._reducer(x, method)
+        if method == 'tsne':
+            return _tsne_transform(entry, x, np.asarray(x_new))
+        return entry['reducer'].transform(np.asarray(x_new))
+
+    def _reducer(self, x, method):
+        return _reducer_entry(np.asarray(x), method)
 
     def visualise(self, x, y=None, method='pca'):
         x_reduced = self.dim_reduction(x, method=method)
@@ -53,38 +248,60 @@ class EvaluationFramework:
         if x_reduced is None:
             print('Method not recognised')
             return
-        plt.plot(x_reduced[y==0,0], x_reduced[y==0,1], '.',label="Normal")
-        plt.plot(x_reduced[y==1,0], x_reduced[y==1,1], 'x',label="Anomaly")
-        plt.title(label=method.upper())
-        plt.legend()
-
-        if method == 'pca':
-            plt.ylabel('PCA2')
-            plt.xlabel('PCA1')
-
-    def contour(self,x,method="pca"):
-        # Dimension Reduction
-        if method == 'pca':
-            reducer = PCA(n_components=2)
-        elif method == 'umap':
-            reducer = UMAP()
-        else:
+        plot_reduced(x_reduced, y, method)
+
+    def contour(self, x, method="pca", resolution=50, adaptive=False, coarse=5):
+        '''
+            Anomaly probabilities over a (resolution, resolution) grid in
+            the 2D embedding of `x`, mapped back to the input space.
+            The fitted reducer and the mapped grid are cached per dataset.
+            adaptive :: score a grid of every `coarse`-th point, then only
+                the full resolution points of coarse cells whose corners
+                are labelled differently (near the decision boundary),
+                the rest are interpolated from the coarse grid
+            returns xcoords, ycoords, x_grid and (resolution**2, 2) y_preds
+        '''
+        if method not in contour_methods:
             print('Failed to find method.')
             return
+        entry = self._reducer(x, method)
 
         # Grid Coordinates
-        reducer.fit(x)
-        x_reduced = reducer.fit_transform(x)
-        x_min, y_min = x_reduced.min(0)
-        x_max, y_max = x_reduced.max(0)
-        xcoords = np.linspace(x_min,x_max,50)
-        ycoords = np.linspace(y_min,y_max,50)
-
-        x_grid = np.array([[i,j] for i in xcoords for j in ycoords])
-
-        x_ = reducer.inverse_transform(x_grid)
-        y_preds = self.model.predict_proba(x_)
-        return xcoords,ycoords,x_grid,y_preds
+        if resolution not in entry['grids']:
+            xcoords, ycoords, x_grid = grid(entry['embedding'], resolution)
+            entry['grids'][resolution] = xcoords, ycoords, x_grid, entry['reducer'].inverse_transform(x_grid)
+        xcoords, ycoords, x_grid, x_ = entry['grids'][resolution]
+
+        if not adaptive:
+            y_preds = self.model.predict_proba(x_)
+            return xcoords,ycoords,x_grid,y_preds
+        return xcoords,ycoords,x_grid,self._adaptive_proba(x_, resolution, coarse)
+
+    def _adaptive_proba(self, x_, resolution, coarse):
+        # Coarse grid indices, always including the last row and column
+        idx = np.unique(np.r_[np.arange(0, resolution, coarse), resolution - 1])
+        points = x_.reshape(resolution, resolution, -1)
+        labels, proba = _member_outputs(self.model, points[np.ix_(idx, idx)].reshape(len(idx)**2, -1))
+        labels, proba = labels.reshape(len(idx), len(idx)), proba.reshape(len(idx), len(idx))
+
+        fine = np.arange(resolution)
+        interpolator = RegularGridInterpolator((idx, idx), proba)
+        ii, jj = np.meshgrid(fine, fine, indexing='ij')
+        z = interpolator(np.column_stack([ii.ravel(), jj.ravel()])).reshape(resolution, resolution)
+        z[np.ix_(idx, idx)] = proba
+
+        if len(idx) > 1:
+            # Coarse cells with differently labelled corners hold the boundary
+            corners = np.stack([labels[:-1,:-1], labels[1:,:-1], labels[:-1,1:], labels[1:,1:]])
+            boundary = corners.min(0) != corners.max(0)
+            cell = np.clip(np.searchsorted(idx, fine, side='right') - 1, 0, len(idx) - 2)
+            refine = boundary[np.ix_(cell, cell)]
+            refine[np.ix_(idx, idx)] = False
+            if refine.any():
+                _, z[refine] = _member_outputs(self.model, points[refine])
+
+        z = z.ravel()
+        return np.column_stack([1 - z, z])
 
     def heatmap(self, x, method='pca'):
         _,_,x_grid,y_preds = self.contour(x,method)
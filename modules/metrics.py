@@ -1,32 +1,280 @@
-from sklearn.metrics import roc_auc_score, recall_score, f1_score, log_loss
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, update_wrapper
+import numpy as np
+import pandas as pd
 
-def false_alarm_rate(y_true, y_pred):
-    threshold = 0.5
-    FP, N = 0, 0
-    for true, pred in zip(y_true, y_pred):
-        if true == 0:
-            N += 1
-            if pred > threshold:
-                FP += 1
+# Probabilities are clipped to [EPS, 1 - EPS] in log losses, the
+# float64 machine epsilon as in sklearn's log_loss
+EPS = np.finfo(np.float64).eps
+
+class ScoreStats:
+    """
+        Inputs of a metric computation converted once to NumPy, with
+        the intermediates shared by every metric: confusion counts at
+        `threshold` and the ascending score order and tie-averaged
+        ranks used by ranking metrics (computed on first use).
+    """
+    def __init__(self, y_true, y_pred, threshold=0.5):
+        self.y_true = np.asarray(y_true)
+        self.y_pred = np.asarray(y_pred, dtype=float)
+        self.threshold = threshold
+        self.positive = self.y_true == 1
+
+        flagged = self.y_pred > threshold
+        self.flagged = flagged
+        self.tp = int(np.count_nonzero(self.positive & flagged))
+        self.fp = int(np.count_nonzero(~self.positive & flagged))
+        self.fn = int(np.count_nonzero(self.positive & ~flagged))
+        self.tn = int(np.count_nonzero(~self.positive & ~flagged))
+
+    @cached_property
+    def order(self):
+        return np.argsort(self.y_pred, kind='mergesort')
+
+    @cached_property
+    def tie_starts(self):
+        """
+            Start of each group of tied scores in sorted order.
+        """
+        sorted_pred = self.y_pred.ravel()[self.order]
+        return np.flatnonzero(np.r_[True, sorted_pred[1:] != sorted_pred[:-1]])
+
+    @cached_property
+    def ranks(self):
+        """
+            1-based ranks of y_pred, tied scores share their average rank.
+        """
+        starts = self.tie_starts
+        ends = np.r_[starts[1:], len(self.order)]
+        group_sizes = ends - starts
+        ranks = np.empty(len(self.order))
+        ranks[self.order] = np.repeat((starts + ends + 1) / 2, group_sizes)
+        return ranks
+
+    @cached_property
+    def cum_positive(self):
+        """
+            Number of positives among the i+1 lowest scores.
+        """
+        return np.cumsum(self.positive.ravel()[self.order])
+
+    def counts_at(self, n_below):
+        """
+            True and false positives when everything but the
+            `n_below` lowest scores is flagged, for an array of counts.
+        """
+        n_below = np.asarray(n_below)
+        pos_below = np.where(n_below > 0, self.cum_positive[np.maximum(n_below - 1, 0)], 0)
+        P = self.cum_positive[-1] if len(self.cum_positive) else 0
+        tp = P - pos_below
+        fp = (len(self.order) - P) - (n_below - pos_below)
+        return tp, fp
+
+def stats_metric(from_stats):
+    """
+        Turn a metric of `ScoreStats` into a `func(y_true, y_pred)`
+        metric that `MetricCollection` can feed shared intermediates
+        through `func.from_stats`.
+    """
+    def metric(y_true, y_pred):
+        return from_stats(ScoreStats(y_true, y_pred))
+    update_wrapper(metric, from_stats)
+    metric.from_stats = from_stats
+    return metric
+
+@stats_metric
+def false_alarm_rate(stats):
+    N = stats.fp + stats.tn
     if N == 0:
         return 0
-    return float(FP/N)
+    return float(stats.fp/N)
+
+@stats_metric
+def recall(stats):
+    P = stats.tp + stats.fn
+    if P == 0:
+        return 0.0
+    return stats.tp/P
+
+@stats_metric
+def f1(stats):
+    denominator = 2*stats.tp + stats.fp + stats.fn
+    if denominator == 0:
+        return 0.0
+    return 2*stats.tp/denominator
+
+@stats_metric
+def roc_auc(stats):
+    """
+        Mann-Whitney ROC-AUC from the tie-averaged ranks, equal to
+        `roc_auc_score` for binary labels.
+    """
+    P = np.count_nonzero(stats.positive)
+    N = len(stats.positive) - P
+    if P == 0 or N == 0:
+        raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+    return float((stats.ranks[stats.positive].sum() - P*(P+1)/2) / (P*N))
+
+@stats_metric
+def log_likelihood(stats, eps=EPS):
+    """
+        Binary log loss of the anomaly probabilities, as `log_loss`.
+    """
+    p = np.clip(stats.y_pred, eps, 1 - eps)
+    return float(-np.mean(np.where(stats.positive, np.log(p), np.log(1 - p))))
+
+class MetricAccumulator:
+    """
+        Mergeable running state for metrics over streamed predictions:
+        exact confusion counts at `threshold`, running log loss sums
+        and per-class histograms of the scores over [0, 1] in `n_bins`
+        bins for an approximate ROC-AUC (scores sharing a bin count
+        as ties). Update chunk by chunk and merge accumulators from
+        different workers with `merge` or `+`.
+    """
+    def __init__(self, n_bins=1000, threshold=0.5, eps=EPS):
+        self.n_bins = n_bins
+        self.threshold = threshold
+        self.eps = eps
+        self.tp = self.fp = self.fn = self.tn = 0
+        self.log_loss_sum = 0.0
+        self.count = 0
+        self.pos_hist = np.zeros(n_bins, dtype=np.int64)
+        self.neg_hist = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        stats = ScoreStats(y_true, y_pred, self.threshold)
+        self.tp += stats.tp
+        self.fp += stats.fp
+        self.fn += stats.fn
+        self.tn += stats.tn
+
+        p = np.clip(stats.y_pred, self.eps, 1 - self.eps)
+        self.log_loss_sum -= np.where(stats.positive, np.log(p), np.log(1 - p)).sum()
+        self.count += stats.y_pred.size
+
+        bins = np.clip((stats.y_pred * self.n_bins).astype(int), 0, self.n_bins - 1)
+        self.pos_hist += np.bincount(bins[stats.positive], minlength=self.n_bins)
+        self.neg_hist += np.bincount(bins[~stats.positive], minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        if (self.n_bins, self.threshold) != (other.n_bins, other.threshold):
+            raise ValueError('Accumulators must share n_bins and threshold to be merged.')
+        self.tp += other.tp
+        self.fp += other.fp
+        self.fn += other.fn
+        self.tn += other.tn
+        self.log_loss_sum += other.log_loss_sum
+        self.count += other.count
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+        return self
+
+    def __add__(self, other):
+        merged = MetricAccumulator(self.n_bins, self.threshold, self.eps)
+        return merged.merge(self).merge(other)
+
+    def roc_auc(self):
+        P, N = self.pos_hist.sum(), self.neg_hist.sum()
+        if P == 0 or N == 0:
+            raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+        neg_below = np.cumsum(self.neg_hist) - self.neg_hist
+        return float((self.pos_hist * (neg_below + self.neg_hist/2)).sum() / (P*N))
+
+    def log_likelihood(self):
+        return float(self.log_loss_sum / self.count)
 
-def recall(y_true, y_pred):
-    y_pred_binary = [1 if x > 0.5 else 0 for x in y_pred]
-    return recall_score(y_true, y_pred_binary)
+# Metrics that can be computed from a MetricAccumulator, the
+# confusion metrics read the same counts as from a ScoreStats
+false_alarm_rate.from_accumulator = false_alarm_rate.from_stats
+recall.from_accumulator = recall.from_stats
+f1.from_accumulator = f1.from_stats
+roc_auc.from_accumulator = MetricAccumulator.roc_auc
+log_likelihood.from_accumulator = MetricAccumulator.log_likelihood
+
+class BootstrapStats:
+    """
+        Metric intermediates for a batch of bootstrap replicates of a
+        `ScoreStats`. Replicates are given as (n_replicates, n_samples)
+        resampling counts, so confusion counts are matrix products
+        and ROC-AUC reuses the single sort of the original scores.
+    """
+    def __init__(self, stats, counts):
+        self.stats = stats
+        self.counts = counts
+        positive = stats.positive.ravel()
+        flagged = stats.flagged.ravel()
+        self.tp = counts @ (positive & flagged)
+        self.fp = counts @ (~positive & flagged)
+        self.fn = counts @ (positive & ~flagged)
+        self.tn = counts @ (~positive & ~flagged)
+
+    def roc_auc(self):
+        stats = self.stats
+        sorted_counts = self.counts[:, stats.order]
+        sorted_positive = stats.positive.ravel()[stats.order]
+        # Weighted Mann-Whitney statistic over the groups of tied scores
+        pos = np.add.reduceat(sorted_counts * sorted_positive, stats.tie_starts, axis=1)
+        neg = np.add.reduceat(sorted_counts * ~sorted_positive, stats.tie_starts, axis=1)
+        neg_below = np.cumsum(neg, axis=1) - neg
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (pos * (neg_below + neg/2)).sum(axis=1) / (pos.sum(axis=1) * neg.sum(axis=1))
+
+    def log_likelihood(self, eps=EPS):
+        stats = self.stats
+        p = np.clip(stats.y_pred.ravel(), eps, 1 - eps)
+        losses = -np.where(stats.positive.ravel(), np.log(p), np.log(1 - p))
+        return self.counts @ losses / self.counts.sum(axis=1)
+
+def _rate(numerator, denominator):
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), 0.0)
+
+def _bootstrap_false_alarm_rate(b):
+    return _rate(b.fp, b.fp + b.tn)
+
+def _bootstrap_recall(b):
+    return _rate(b.tp, b.tp + b.fn)
+
+def _bootstrap_f1(b):
+    return _rate(2*b.tp, 2*b.tp + b.fp + b.fn)
+
+# Metrics that can be computed for a BootstrapStats batch
+false_alarm_rate.from_bootstrap = _bootstrap_false_alarm_rate
+recall.from_bootstrap = _bootstrap_recall
+f1.from_bootstrap = _bootstrap_f1
+roc_auc.from_bootstrap = BootstrapStats.roc_auc
+log_likelihood.from_bootstrap = BootstrapStats.log_likelihood
+
+def _bootstrap_batch(y_true, y_pred, metrics, seed, n_replicates):
+    """
+        Metric values of `n_replicates` bootstrap replicates drawn
+        together from the batch's own seed, so results do not depend
+        on which worker runs the batch.
+    """
+    stats = ScoreStats(y_true, y_pred)
+    n = stats.y_pred.size
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, n, size=(n_replicates, n))
+    offsets = np.arange(n_replicates)[:, None] * n
+    counts = np.bincount((idx + offsets).ravel(), minlength=n_replicates * n).reshape(n_replicates, n)
+    batch = BootstrapStats(stats, counts)
+
+    values = {}
+    for metric, func in metrics.items():
+        if hasattr(func, 'from_bootstrap'):
+            values[metric] = np.asarray(func.from_bootstrap(batch), dtype=float)
+        else:
+            values[metric] = np.array([func(stats.y_true[i], stats.y_pred[i]) for i in idx], dtype=float)
+    return values
 
-def f1(y_true, y_pred):
-    y_pred_binary = [1 if x > 0.5 else 0 for x in y_pred]
-    return f1_score(y_true, y_pred_binary)
-    
 metrics = {
-    'ROC-AUC': roc_auc_score,
+    'ROC-AUC': roc_auc,
     'Detection-Rate': recall,
     'False-Alarm': false_alarm_rate,
     'F1-Score': f1,
-    'Log-Likelihood': log_loss
+    'Log-Likelihood': log_likelihood
 }
 
 class MetricCollection:
@@ -37,30 +285,128 @@ class MetricCollection:
         """
             Initialise a dictionary of metrics to compute.
             Metrics of the form (name,metrics_functions).
-            Compute metrics from a list of `y_true` and 
+            Compute metrics from a list of `y_true` and
             `y_pred` labels.
         """
         self._metrics = metrics
         self._store = defaultdict(list)
-                
+
     def compute(self, y_true, y_pred):
         """
-            Compute each metric from a list of 
+            Compute each metric from a list of
             `y_true` and `y_pred` labels.
+            Inputs are converted once and metrics with a
+            `from_stats` method share the confusion counts
+            and score ordering of a single `ScoreStats`.
+        """
+        stats = ScoreStats(y_true, y_pred)
+        results = {}
+        for metric, func in self._metrics.items():
+            if hasattr(func, 'from_stats'):
+                val = func.from_stats(stats)
+            else:
+                val = func(stats.y_true, stats.y_pred)
+            results[metric] = val
+            self._store[metric].append(val)
+        return results
+
+    def sweep(self, y_true, y_pred, thresholds=None, contamination=None):
+        """
+            Detection rate, false alarm rate, precision and F1 at
+            every threshold in `thresholds` (scores above are flagged)
+            or at every contamination level in `contamination` (at least
+            the top fraction of scores is flagged, scores tied at the
+            cutoff are all flagged), from one sort of the scores.
+            Threshold is always the score above which samples are
+            flagged. Returns a DataFrame with a row per operating point.
+        """
+        stats = ScoreStats(y_true, y_pred)
+        sorted_pred = stats.y_pred.ravel()[stats.order]
+        n = len(sorted_pred)
+        if contamination is not None:
+            contamination = np.atleast_1d(np.asarray(contamination, dtype=float))
+            n_below = n - np.ceil(contamination * n).astype(int)
+            # Snap down to the start of the group of scores tied at the cutoff
+            cutoff = sorted_pred[np.clip(n_below, 0, n - 1)]
+            n_below = np.where(n_below < n, np.searchsorted(sorted_pred, cutoff, side='left'), n)
+            thresholds = np.where(n_below > 0, sorted_pred[np.maximum(n_below - 1, 0)], -np.inf)
+            thresholds = np.where(n_below < n, thresholds, np.inf)
+        else:
+            thresholds = np.atleast_1d(np.asarray([0.5] if thresholds is None else thresholds, dtype=float))
+            n_below = np.searchsorted(sorted_pred, thresholds, side='right')
+        tp, fp = stats.counts_at(n_below)
+        P = int(np.count_nonzero(stats.positive))
+        N = n - P
+        flagged = tp + fp
+
+        results = {
+            'Threshold': thresholds,
+            'Detection-Rate': tp / P if P else np.zeros(len(tp)),
+            'False-Alarm': fp / N if N else np.zeros(len(fp)),
+            'Precision': np.where(flagged > 0, tp / np.maximum(flagged, 1), 0.0),
+            'F1-Score': np.where(flagged + P > 0, 2*tp / np.maximum(flagged + P, 1), 0.0)
+        }
+        if contamination is not None:
+            results = {'Contamination': contamination, **results}
+        return pd.DataFrame(results)
+
+    def bootstrap(self, y_true, y_pred, n_replicates=1000, alpha=0.05, batch_size=100,
+                  n_jobs=1, random_state=None):
+        """
+            Percentile bootstrap confidence intervals of each metric.
+            Replicates are drawn as vectorised index resamples in
+            batches of `batch_size`, each batch from its own seed so
+            results are reproducible for any `n_jobs`; batches run in
+            a process pool when `n_jobs` > 1. Replicates where a metric
+            is undefined (e.g. one class for ROC-AUC) are ignored.
+            Returns a DataFrame of the estimate and the interval bounds
+            indexed by metric.
+        """
+        stats = ScoreStats(y_true, y_pred)
+        sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+        seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+        args = [(stats.y_true, stats.y_pred, self._metrics, seed, size) for seed, size in zip(seeds, sizes)]
+        if n_jobs == 1:
+            batches = [_bootstrap_batch(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs) as pool:
+                batches = list(pool.map(_bootstrap_batch, *zip(*args)))
+
+        rows = {}
+        for metric, func in self._metrics.items():
+            values = np.concatenate([b[metric] for b in batches])
+            estimate = func.from_stats(stats) if hasattr(func, 'from_stats') else func(stats.y_true, stats.y_pred)
+            lower, upper = np.nanpercentile(values, [100*alpha/2, 100*(1 - alpha/2)])
+            rows[metric] = {'Estimate': estimate, 'Lower': lower, 'Upper': upper}
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+    def accumulator(self, **kwargs):
+        """
+            New `MetricAccumulator` for streamed predictions.
+        """
+        return MetricAccumulator(**kwargs)
+
+    def compute_accumulated(self, accumulator):
+        """
+            Compute each metric from a `MetricAccumulator` (possibly
+            merged across workers) instead of full label arrays.
+            Metrics must provide a `from_accumulator` method.
         """
         results = {}
         for metric, func in self._metrics.items():
-            val = func(y_true,y_pred)
+            if not hasattr(func, 'from_accumulator'):
+                raise ValueError(f'Metric {metric} cannot be computed from an accumulator.')
+            val = func.from_accumulator(accumulator)
             results[metric] = val
             self._store[metric].append(val)
         return results
-    
+
     def clear(self):
         """
             Clear stored metric computations.
         """
         self._store = defaultdict(list)
-        
+
     def get_computes(self):
-        return self._store 
-    
+        return self._store
+
@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+'''
+    Module for sharing arrays with process pool workers
+'''
+
+# Arrays attached from shared memory in this worker, by name
+shared = {}
+_segments = []
+
+
+@contextmanager
+def shared_arrays(**arrays):
+    """
+        Copy arrays into shared memory segments for the duration
+        of the block, yielding the spec workers attach with
+        `attach_shared`.
+    """
+    segments = []
+    try:
+        spec = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            segments.append(shm)
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            spec[name] = (shm.name, a.shape, a.dtype.str)
+        yield spec
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def attach_shared(spec):
+    """
+        Process pool initializer, maps the shared arrays once per
+        worker into `shared`. Segments stay attached for the
+        lifetime of the worker since fitted models may hold views
+        into them.
+    """
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _segments.append(shm)
+        shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)